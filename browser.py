@@ -1,15 +1,26 @@
+import bisect
+import codecs
+import collections
+import concurrent.futures
+import hashlib
+import json
+import mmap
+import os
+import re
 import socket
 import ssl
 import sys
+import threading
 import time
+import types
 import tkinter
 import tkinter.font
 import shlex
 import urllib.parse
+import zlib
 import dukpy
 
 
-cache = {}
 timers = set()
 BLOCK_ELEMENTS = [
     "html", "body", "article", "section", "nav", "aside",
@@ -53,7 +64,458 @@ def tree_to_list(tree, list):
     return list
 
 
+MAX_CONNECTIONS_PER_HOST = 6
+CONNECTION_IDLE_TIMEOUT = 30
+CONNECTION_WAIT_TIMEOUT = 30
+SSL_CONTEXT = ssl.create_default_context()
+
+
+class ConnectionPool:
+    def __init__(self, max_per_host=MAX_CONNECTIONS_PER_HOST,
+                 idle_timeout=CONNECTION_IDLE_TIMEOUT,
+                 wait_timeout=CONNECTION_WAIT_TIMEOUT):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        self.idle = {}
+        self.open = {}
+        self.lock = threading.Condition()
+
+    def expire(self, key):
+        now = time.time()
+        idle = self.idle.get(key, [])
+        while idle and now - idle[0][2] > self.idle_timeout:
+            s, _, _ = idle.pop(0)
+            s.close()
+            self.open[key] -= 1
+            self.lock.notify_all()
+
+    def connect(self, scheme, host, port):
+        key = (scheme, host, port)
+        deadline = time.time() + self.wait_timeout
+        with self.lock:
+            while True:
+                self.expire(key)
+                if self.idle.get(key):
+                    s, response, _ = self.idle[key].pop()
+                    return s, response, True
+                if self.open.get(key, 0) < self.max_per_host:
+                    self.open[key] = self.open.get(key, 0) + 1
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TimeoutError(
+                        "No free connection to {}".format(host))
+                self.lock.wait(remaining)
+
+        s = socket.socket(
+            family=socket.AF_INET,
+            type=socket.SOCK_STREAM,
+            proto=socket.IPPROTO_TCP,
+        )
+        try:
+            s.connect((host, port))
+        except BaseException:
+            self.discard(key, s)
+            raise
+        if scheme == "https":
+            try:
+                s = SSL_CONTEXT.wrap_socket(s, server_hostname=host)
+            except Exception:
+                self.discard(key, s)
+                return None, None, False
+        return s, s.makefile("rb"), False
+
+    def release(self, key, s, response):
+        with self.lock:
+            self.idle.setdefault(key, []).append((s, response, time.time()))
+            self.lock.notify_all()
+
+    def discard(self, key, s):
+        s.close()
+        with self.lock:
+            self.open[key] -= 1
+            self.lock.notify_all()
+
+    def close_all(self):
+        with self.lock:
+            for key, idle in self.idle.items():
+                for s, _, _ in idle:
+                    s.close()
+                    self.open[key] -= 1
+            self.idle = {}
+            self.lock.notify_all()
+
+
+POOL = ConnectionPool()
+CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+
+def parse_cache_control(value):
+    directives = {}
+    for directive in value.split(","):
+        directive = directive.strip().lower()
+        if "=" in directive:
+            name, arg = directive.split("=", 1)
+            directives[name.strip()] = arg.strip().strip('"')
+        elif directive:
+            directives[directive] = ""
+    return directives
+
+
+class CacheEntry:
+    def __init__(self, headers, body, stored=None):
+        self.headers = headers
+        self.body = body
+        self.size = len(body.encode("utf8"))
+        self.refresh(headers, stored)
+
+    def refresh(self, headers, stored=None):
+        self.headers.update(headers)
+        self.stored = stored if stored is not None else time.time()
+        directives = parse_cache_control(
+            self.headers.get("cache-control", ""))
+        self.no_cache = "no-cache" in directives
+        try:
+            self.max_age = int(directives.get("max-age", "0"))
+        except ValueError:
+            self.max_age = 0
+
+    def fresh(self):
+        if self.no_cache:
+            return False
+        return time.time() - self.stored < self.max_age
+
+    def validators(self):
+        validators = {}
+        if "etag" in self.headers:
+            validators["If-None-Match"] = self.headers["etag"]
+        if "last-modified" in self.headers:
+            validators["If-Modified-Since"] = self.headers["last-modified"]
+        return validators
+
+    def __repr__(self):
+        return "CacheEntry(size={}, max_age={}, no_cache={})".format(
+            self.size, self.max_age, self.no_cache)
+
+
+DISK_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+
+class DiskCache:
+    def __init__(self, directory, max_bytes=DISK_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.objects = os.path.join(directory, "objects")
+        self.index_path = os.path.join(directory, "index")
+        os.makedirs(self.objects, exist_ok=True)
+        # url -> (digest, stored, size, headers), oldest first
+        self.index = collections.OrderedDict()
+        self.refs = {}
+        self.size = 0
+        self.records = 0
+        self.lock = threading.Lock()
+        self.load_index()
+
+    def load_index(self):
+        if not os.path.exists(self.index_path) or \
+           os.path.getsize(self.index_path) == 0:
+            return
+        with open(self.index_path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                torn = m[len(m) - 1:] != b"\n"
+                for line in iter(m.readline, b""):
+                    self.records += 1
+                    try:
+                        self.load_record(line)
+                    except (ValueError, IndexError):
+                        # a record torn by a crash mid-append
+                        continue
+        for url, (digest, _, _, _) in list(self.index.items()):
+            if not os.path.exists(self.object_path(digest)):
+                self.forget(url)
+        if torn:
+            self.compact()
+
+    def load_record(self, line):
+        fields = line.decode("utf8").rstrip("\n").split("\t")
+        if fields[1] == "-":
+            self.forget(fields[0])
+            return
+        url, digest, stored, size, headers = fields
+        headers = json.loads(headers)
+        if not isinstance(headers, dict):
+            raise ValueError("Bad headers in cache index")
+        self.remember(url, digest, float(stored), int(size), headers)
+
+    def object_path(self, digest):
+        return os.path.join(self.objects, digest)
+
+    def remember(self, url, digest, stored, size, headers):
+        self.forget(url)
+        self.index[url] = (digest, stored, size, headers)
+        if digest not in self.refs:
+            self.refs[digest] = 0
+            self.size += size
+        self.refs[digest] += 1
+
+    def forget(self, url):
+        if url not in self.index:
+            return None
+        digest, _, size, _ = self.index.pop(url)
+        self.refs[digest] -= 1
+        if self.refs[digest] == 0:
+            del self.refs[digest]
+            self.size -= size
+            return digest
+        return None
+
+    def append_record(self, fields):
+        with open(self.index_path, "a", encoding="utf8") as f:
+            f.write("\t".join(fields) + "\n")
+        self.records += 1
+
+    def get(self, url):
+        with self.lock:
+            if url not in self.index:
+                return None
+            digest, stored, _, headers = self.index[url]
+            self.index.move_to_end(url)
+        try:
+            with open(self.object_path(digest), "rb") as f:
+                body = f.read().decode("utf8")
+        except OSError:
+            self.remove(url)
+            return None
+        return CacheEntry(dict(headers), body, stored)
+
+    def put(self, url, entry):
+        data = entry.body.encode("utf8")
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            tmp = path + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        # cookies are session state, not part of the cached resource
+        headers = {header: value for header, value in entry.headers.items()
+                   if header != "set-cookie"}
+        with self.lock:
+            self.remember(url, digest, entry.stored, len(data), headers)
+            self.append_record([url, digest, str(entry.stored),
+                                str(len(data)), json.dumps(headers)])
+            while self.size > self.max_bytes and len(self.index) > 1:
+                oldest = next(iter(self.index))
+                self.delete(oldest)
+            if self.records > 2 * len(self.index) + 64:
+                self.compact()
+
+    def remove(self, url):
+        with self.lock:
+            if url in self.index:
+                self.delete(url)
+
+    def delete(self, url):
+        digest = self.forget(url)
+        self.append_record([url, "-"])
+        if digest:
+            try:
+                os.remove(self.object_path(digest))
+            except OSError:
+                pass
+
+    def compact(self):
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w", encoding="utf8") as f:
+            for url, (digest, stored, size, headers) in self.index.items():
+                f.write("\t".join([url, digest, str(stored), str(size),
+                                   json.dumps(headers)]) + "\n")
+        os.replace(tmp, self.index_path)
+        self.records = len(self.index)
+
+
+class HTTPCache:
+    def __init__(self, max_bytes=CACHE_MAX_BYTES, disk=None):
+        self.max_bytes = max_bytes
+        self.disk = disk
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry:
+                self.entries.move_to_end(url)
+                return entry
+        if self.disk:
+            entry = self.disk.get(url)
+            if entry:
+                self.insert(url, entry)
+        return entry
+
+    def lookup(self, url):
+        entry = self.get(url)
+        fresh = bool(entry and entry.fresh())
+        with self.lock:
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return entry, fresh
+
+    def put(self, url, headers, body):
+        directives = parse_cache_control(headers.get("cache-control", ""))
+        if "no-store" in directives:
+            self.invalidate(url)
+            return
+        entry = CacheEntry(dict(headers), body)
+        if not entry.max_age and not entry.validators():
+            return
+        self.insert(url, entry)
+        if self.disk:
+            self.disk.put(url, entry)
+
+    def revalidated(self, url, entry, headers):
+        with self.lock:
+            self.revalidations += 1
+        entry.refresh(headers)
+        if self.disk:
+            self.disk.put(url, entry)
+
+    def insert(self, url, entry):
+        if entry.size > self.max_bytes:
+            return
+        with self.lock:
+            if url in self.entries:
+                self.size -= self.entries.pop(url).size
+            self.entries[url] = entry
+            self.size += entry.size
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.size
+
+    def invalidate(self, url):
+        with self.lock:
+            if url in self.entries:
+                self.size -= self.entries.pop(url).size
+        if self.disk:
+            self.disk.remove(url)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidations": self.revalidations,
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "disk_entries": len(self.disk.index) if self.disk else 0,
+                "disk_bytes": self.disk.size if self.disk else 0,
+            }
+
+
+CACHE = HTTPCache()
+
+
+READ_CHUNK_SIZE = 64 * 1024
+FETCHER = concurrent.futures.ThreadPoolExecutor(
+    max_workers=MAX_CONNECTIONS_PER_HOST)
+
+
+class ResponseBody:
+    def __init__(self, chunks, complete=False):
+        self.chunks = chunks
+        self.complete = complete
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+
+def body_chunks(response, headers, body=None):
+    transfer_encoding = headers.get("transfer-encoding", "identity").lower()
+    assert transfer_encoding in ["identity", "chunked"], \
+        "Unsupported transfer-encoding {}".format(transfer_encoding)
+
+    if transfer_encoding == "chunked":
+        while True:
+            line = response.readline()
+            if not line:
+                raise ConnectionError("Connection closed mid-chunk")
+            size = int(line.split(b";", 1)[0].strip(), 16)
+            if size == 0:
+                break
+            while size > 0:
+                data = response.read1(min(size, READ_CHUNK_SIZE))
+                if not data:
+                    raise ConnectionError("Connection closed mid-chunk")
+                size -= len(data)
+                yield data
+            response.readline()
+        # skip any trailer headers
+        while response.readline() not in [b"\r\n", b""]:
+            pass
+    elif "content-length" in headers:
+        remaining = int(headers["content-length"])
+        while remaining > 0:
+            data = response.read1(min(remaining, READ_CHUNK_SIZE))
+            if not data:
+                raise ConnectionError("Connection closed mid-body")
+            remaining -= len(data)
+            if not remaining and body:
+                body.complete = True
+            yield data
+    else:
+        while True:
+            data = response.read1(READ_CHUNK_SIZE)
+            if not data:
+                break
+            yield data
+
+
+def decode_content(chunks, encoding):
+    if encoding == "identity":
+        yield from chunks
+        return
+    assert encoding in ["gzip", "deflate"], \
+        "Unsupported content-encoding {}".format(encoding)
+
+    if encoding == "gzip":
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    else:
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS)
+    # some servers send deflate without the zlib header; that shows up as
+    # an error within the first two bytes, so keep those for a retry
+    head = b"" if encoding == "deflate" else None
+    for chunk in chunks:
+        try:
+            data = decompressor.decompress(chunk)
+        except zlib.error:
+            if head is None or len(head) >= 2:
+                raise
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            data = decompressor.decompress(head + chunk)
+            head = None
+        if head is not None and len(head) < 2:
+            head += chunk[:2 - len(head)]
+        if data:
+            yield data
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
 def request(url, top_level_url, payload=None, refer_policy=None):
+    headers, chunks, secure = request_stream(
+        url, top_level_url, payload, refer_policy)
+    return headers, "".join(chunks), secure
+
+
+def request_stream(url, top_level_url, payload=None, refer_policy=None):
     scheme, url = url.split("://", 1)
     assert scheme in ["http", "https"], \
         "Unknown scheme {}".format(scheme)
@@ -69,24 +531,24 @@ def request(url, top_level_url, payload=None, refer_policy=None):
         host, port = host.split(":", 1)
         port = int(port)
 
-    s = socket.socket(
-        family=socket.AF_INET,
-        type=socket.SOCK_STREAM,
-        proto=socket.IPPROTO_TCP,
-    )
-
-    s.connect((host, port))
-
-    if scheme == "https":
-        try:
-            ctx = ssl.create_default_context()
-            s = ctx.wrap_socket(s, server_hostname=host)
-        except Exception:
-            return {}, "<!doctype html>\nSecure Connection Failed", False
-
     method = "POST" if payload else "GET"
-    body = "{} {} HTTP/1.0\r\n".format(method, path)
+    cache_url = scheme + "://" + url
+    entry = None
+    if method == "GET":
+        entry, fresh = CACHE.lookup(cache_url)
+        if fresh:
+            return dict(entry.headers), ResponseBody([entry.body], True), \
+                scheme == "https"
+    else:
+        CACHE.invalidate(cache_url)
+
+    body = "{} {} HTTP/1.1\r\n".format(method, path)
     body += "Host: {}\r\n".format(host)
+    body += "Connection: keep-alive\r\n"
+    body += "Accept-Encoding: gzip, deflate\r\n"
+    if entry:
+        for header, value in entry.validators().items():
+            body += "{}: {}\r\n".format(header, value)
     if host in COOKIE_JAR:
         cookie, params = COOKIE_JAR[host]
         allow_cookie = True
@@ -114,43 +576,113 @@ def request(url, top_level_url, payload=None, refer_policy=None):
         body += "Referer: {}\r\n".format(top_level_url)
 
     body += "\r\n" + (payload if payload else "")
-    s.send(body.encode("utf8"))
-    response = s.makefile("r", encoding="utf8", newline="\r\n")
 
-    statusline = response.readline()
-    version, status, explanation = statusline.split(" ", 2)
-    assert status == "200", "{}: {}".format(status, explanation)
-
-    headers = {}
+    key = (scheme, host, port)
     while True:
-        line = response.readline()
-        if line == "\r\n":
+        s, response, reused = POOL.connect(scheme, host, port)
+        if not s:
+            return {}, ResponseBody(
+                ["<!doctype html>\nSecure Connection Failed"], True), False
+        try:
+            s.send(body.encode("utf8"))
+            statusline = response.readline().decode("utf8")
+            if not statusline:
+                raise ConnectionError("Connection closed by server")
             break
-        header, value = line.split(":", 1)
-        headers[header.lower()] = value.strip()
+        except OSError:
+            # an idle connection the server already closed; retry fresh
+            POOL.discard(key, s)
+            if not reused:
+                raise
+        except BaseException:
+            POOL.discard(key, s)
+            raise
+
+    # from here on the socket is counted as open by the pool, so any
+    # failure must hand it back before propagating
+    try:
+        version, status, explanation = statusline.split(" ", 2)
+        assert status == "200" or (entry and status == "304"), \
+            "{}: {}".format(status, explanation)
+
+        headers = {}
+        while True:
+            line = response.readline().decode("utf8")
+            if not line:
+                raise ConnectionError("Connection closed by server")
+            if line == "\r\n":
+                break
+            header, value = line.split(":", 1)
+            headers[header.lower()] = value.strip()
+
+        if "set-cookie" in headers:
+            params = {}
+            if ";" in headers["set-cookie"]:
+                cookie, rest = headers["set-cookie"].split(";", 1)
+                for param_pair in rest.split(";"):
+                    if '=' in param_pair:
+                        name, value = param_pair.strip().split("=", 1)
+                    else:
+                        name = param_pair.strip()
+                        value = ""
+                    params[name.lower()] = value.lower()
+            else:
+                cookie = headers["set-cookie"]
+            COOKIE_JAR[host] = (cookie, params)
 
-    if "set-cookie" in headers:
-        params = {}
-        if ";" in headers["set-cookie"]:
-            cookie, rest = headers["set-cookie"].split(";", 1)
-            for param_pair in rest.split(";"):
-                if '=' in param_pair:
-                    name, value = param_pair.strip().split("=", 1)
-                else:
-                    name = param_pair.strip()
-                    value = ""
-                params[name.lower()] = value.lower()
+        connection = headers.get("connection", "").lower()
+        if version == "HTTP/1.1":
+            keep_alive = connection != "close"
         else:
-            cookie = headers["set-cookie"]
-        COOKIE_JAR[host] = (cookie, params)
-
-    assert "transfer-encoding" not in headers
-    assert "content-encoding" not in headers
+            keep_alive = connection == "keep-alive"
+    except BaseException:
+        POOL.discard(key, s)
+        raise
+
+    if status == "304":
+        if keep_alive:
+            POOL.release(key, s, response)
+        else:
+            POOL.discard(key, s)
+        CACHE.revalidated(cache_url, entry, headers)
+        return dict(entry.headers), ResponseBody([entry.body], True), \
+            scheme == "https"
+
+    chunked = headers.get("transfer-encoding", "").lower() == "chunked"
+    if not chunked and "content-length" not in headers:
+        keep_alive = False
+    body = ResponseBody(None)
+    body.chunks = stream_body(key, s, response, headers, keep_alive,
+                              cache_url if method == "GET" else None, body)
+    return headers, body, scheme == "https"
 
-    body = response.read()
-    s.close()
 
-    return headers, body, scheme == "https"
+def stream_body(key, s, response, headers, keep_alive, cache_url, body):
+    encoding = headers.get("content-encoding", "identity").lower()
+    decoder = codecs.getincrementaldecoder("utf8")()
+    parts = []
+    try:
+        raw = body_chunks(response, headers, body)
+        for data in decode_content(raw, encoding):
+            text = decoder.decode(data)
+            if text:
+                parts.append(text)
+                yield text
+        text = decoder.decode(b"", final=True)
+        if text:
+            parts.append(text)
+            yield text
+    except BaseException:
+        # also reached when the consumer abandons the stream early
+        POOL.discard(key, s)
+        raise
+
+    if keep_alive:
+        POOL.release(key, s, response)
+    else:
+        POOL.discard(key, s)
+    if cache_url:
+        CACHE.put(cache_url, headers, "".join(parts))
 
 
 def layout_mode(node):
@@ -169,10 +701,16 @@ def layout_mode(node):
         return "block"
 
 
+NO_CHILDREN = ()
+EMPTY_ATTRIBUTES = types.MappingProxyType({})
+
+
 class Text:
+    __slots__ = ["text", "children", "parent", "style"]
+
     def __init__(self, text, parent):
         self.text = text
-        self.children = []
+        self.children = NO_CHILDREN
         self.parent = parent
 
     def __repr__(self):
@@ -180,21 +718,207 @@ class Text:
 
 
 class Element:
+    __slots__ = ["tag", "attributes", "children", "parent", "style",
+                 "style_dirty"]
+
     def __init__(self, tag, attributes, parent):
-        self.tag = tag
-        self.attributes = attributes
+        self.tag = sys.intern(tag)
+        self.attributes = attributes or EMPTY_ATTRIBUTES
         self.children = []
         self.parent = parent
+        self.style_dirty = False
+
+    def set_attribute(self, name, value):
+        if self.attributes is EMPTY_ATTRIBUTES:
+            self.attributes = {}
+        self.attributes[sys.intern(name)] = value
 
     def __repr__(self):
         attrs = [" " + k + '="' + v + '"' for k, v in self.attributes.items()]
         return "<" + self.tag + "".join(attrs) + ">"
 
 
+class DocumentIndex:
+    def __init__(self):
+        self.root = None
+        self.by_tag = {}
+        self.by_attribute = {}
+        # element -> number that sorts in document order
+        self.position = {}
+        self.next_position = 0
+        self.unsorted = set()
+
+    def add(self, node, position=None):
+        if not isinstance(node, Element):
+            return
+        if position is None:
+            position = self.next_position
+        self.next_position = max(self.next_position, position + 1)
+        self.position[node] = position
+        self.insert("by_tag", node.tag, node)
+        for name in node.attributes:
+            self.insert("by_attribute", name, node)
+
+    def insert(self, table, key, node):
+        nodes = getattr(self, table).setdefault(key, {})
+        if nodes and self.position[node] < \
+           self.position[next(reversed(nodes))]:
+            self.unsorted.add((table, key))
+        nodes[node] = None
+
+    def remove(self, node):
+        if not isinstance(node, Element):
+            return
+        self.by_tag.get(node.tag, {}).pop(node, None)
+        for name in node.attributes:
+            self.by_attribute.get(name, {}).pop(node, None)
+        self.position.pop(node, None)
+
+    def add_tree(self, tree):
+        for node in tree_to_list(tree, []):
+            self.add(node)
+
+    def remove_tree(self, tree):
+        for node in tree_to_list(tree, []):
+            self.remove(node)
+
+    def set_attribute(self, node, name, value):
+        node.set_attribute(name, value)
+        if node in self.position and \
+           node not in self.by_attribute.get(name, {}):
+            self.insert("by_attribute", name, node)
+
+    def replace_children(self, elt, children):
+        for child in elt.children:
+            self.remove_tree(child)
+        elt.children = children
+        for child in children:
+            child.parent = elt
+        new = [node for child in children
+               for node in tree_to_list(child, [])
+               if isinstance(node, Element)]
+        if not new:
+            return
+        if elt not in self.position:
+            return self.renumber()
+        # the new elements go between elt and whatever follows its subtree
+        low = self.position[elt]
+        high = self.following_position(elt)
+        if high is None:
+            high = max(self.next_position, low + 1) + len(new)
+        step = (high - low) / (len(new) + 1)
+        positions = [low + step * (i + 1) for i in range(len(new))]
+        bounds = [low] + positions + [high]
+        if not all(a < b for a, b in zip(bounds, bounds[1:])):
+            return self.renumber()
+        for node, position in zip(new, positions):
+            self.add(node, position)
+
+    def following_position(self, node):
+        while node.parent:
+            siblings = node.parent.children
+            for i in range(siblings.index(node) + 1, len(siblings)):
+                if siblings[i] in self.position:
+                    return self.position[siblings[i]]
+            node = node.parent
+        return None
+
+    def renumber(self):
+        self.by_tag = {}
+        self.by_attribute = {}
+        self.position = {}
+        self.next_position = 0
+        self.unsorted = set()
+        self.add_tree(self.root)
+
+    def sort(self):
+        # only buckets that were appended to out of order need sorting
+        for table, key in self.unsorted:
+            nodes = getattr(self, table).get(key)
+            if nodes:
+                getattr(self, table)[key] = dict.fromkeys(
+                    sorted(nodes, key=self.position.__getitem__))
+        self.unsorted = set()
+
+    def elements(self, tag, attribute=None):
+        if self.unsorted:
+            self.sort()
+        nodes = self.by_tag.get(tag, {})
+        if attribute is None:
+            return list(nodes)
+        with_attribute = self.by_attribute.get(attribute, {})
+        if len(with_attribute) < len(nodes):
+            return [node for node in with_attribute if node.tag == tag]
+        return [node for node in nodes if attribute in node.attributes]
+
+
+def is_inside(node, ancestor):
+    while node:
+        if node is ancestor:
+            return True
+        node = node.parent
+    return False
+
+
+HTML_DELIMITERS = re.compile("[<>]")
+
+
+def tag_attributes(text):
+    parts = text.split()
+    tag = parts[0].lower()
+    attributes = {}
+    for attrpair in parts[1:]:
+        if "=" in attrpair:
+            key, value = attrpair.split("=", 1)
+            if len(value) > 2 and value[0] in ["'", "\""]:
+                value = value[1:-1]
+            attributes[sys.intern(key.lower())] = value
+        else:
+            attributes[sys.intern(attrpair.lower())] = ""
+    return tag, attributes
+
+
+class PreloadScanner:
+    def __init__(self, preload):
+        self.preload = preload
+        self.buffer = ""
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        start = 0
+        while True:
+            lt = self.buffer.find("<", start)
+            if lt == -1:
+                start = len(self.buffer)
+                break
+            gt = self.buffer.find(">", lt)
+            if gt == -1:
+                start = lt
+                break
+            self.scan_tag(self.buffer[lt + 1:gt])
+            start = gt + 1
+        self.buffer = self.buffer[start:]
+
+    def scan_tag(self, text):
+        if not text[:1].isalpha():
+            return
+        tag, attributes = tag_attributes(text)
+        if tag == "script" and "src" in attributes:
+            self.preload(attributes["src"])
+        elif tag == "link" and "href" in attributes and \
+                attributes.get("rel") == "stylesheet":
+            self.preload(attributes["href"])
+
+
 class HTMLParser:
-    def __init__(self, body):
+    def __init__(self, body=""):
         self.body = body
         self.unfinished = []
+        self.text = ""
+        self.in_tag = False
+        self.mode = "initial"
+        self.open_p = 0
+        self.index = DocumentIndex()
         self.SELF_CLOSING_TAGS = [
             "area", "base", "br", "col", "embed", "hr", "img", "input",
             "link", "meta", "param", "source", "track", "wbr",
@@ -205,37 +929,39 @@ class HTMLParser:
         ]
 
     def parse(self):
-        text = ""
-        in_tag = False
-        for c in self.body:
-            if c == "<":
-                in_tag = True
+        self.feed(self.body)
+        return self.close()
+
+    def feed(self, chunk):
+        # slice whole text and tag spans between delimiters instead of
+        # growing a string one character at a time
+        text = self.text
+        pos = 0
+        for match in HTML_DELIMITERS.finditer(chunk):
+            i = match.start()
+            text += chunk[pos:i]
+            if chunk[i] == "<":
+                self.in_tag = True
                 if text:
                     self.add_text(text)
-                text = ""
-            elif c == ">":
-                in_tag = False
-                self.add_tag(text)
-                text = ""
             else:
-                text += c
-        if not in_tag and text:
-            self.add_text(text)
+                self.in_tag = False
+                self.add_tag(text)
+            text = ""
+            pos = i + 1
+        self.text = text + chunk[pos:]
+
+    def close(self):
+        if not self.in_tag and self.text:
+            self.add_text(self.text)
+        self.text = ""
         return self.finish()
 
+    def root(self):
+        return self.unfinished[0] if self.unfinished else None
+
     def get_attributes(self, text):
-        parts = text.split()
-        tag = parts[0].lower()
-        attributes = {}
-        for attrpair in parts[1:]:
-            if "=" in attrpair:
-                key, value = attrpair.split("=", 1)
-                if len(value) > 2 and value[0] in ["'", "\""]:
-                    value = value[1:-1]
-                attributes[key.lower()] = value
-            else:
-                attributes[attrpair.lower()] = ""
-        return tag, attributes
+        return tag_attributes(text)
 
     def add_text(self, text):
         if text.isspace():
@@ -254,56 +980,76 @@ class HTMLParser:
         if tag.startswith("/"):
             if len(self.unfinished) == 1:
                 return
-            node = self.unfinished.pop()
-            parent = self.unfinished[-1]
-            parent.children.append(node)
+            self.close_element()
         elif tag in self.SELF_CLOSING_TAGS:
             parent = self.unfinished[-1]
             node = Element(tag, attributes, parent)
             parent.children.append(node)
+            self.index.add(node)
         else:
-            found = False
-            parent = self.unfinished[-1] if self.unfinished else None
-
-            # check if there is unclosed paragraph tag
-            for unfinished in self.unfinished:
-                if isinstance(parent, Element) and unfinished.tag == "p":
-                    found = True
-                    break
-
             # close all unclosed tags then reopen them
+            found = self.open_p > 0
             if found and tag == "p":
                 closed_tags = []
                 while True:
-                    node = self.unfinished.pop()
-                    parent2 = self.unfinished[-1]
-                    parent2.children.append(node)
-                    if isinstance(node, Element) and node.tag != "p":
+                    node = self.close_element()
+                    if node.tag != "p":
                         closed_tags.append(node)
-                    if isinstance(node, Element) and node.tag == "p":
+                    else:
                         break
 
-            node = Element(tag, attributes, parent)
-            self.unfinished.append(node)
+            # nodes join their parent as soon as they open, so the tree
+            # can be rendered while the parser is still running
+            self.open_element(tag, attributes)
             if found and tag == "p":
                 for closed in closed_tags:
-                    new = Element(closed.tag, closed.attributes, closed.parent)
-                    self.unfinished.append(new)
+                    self.open_element(closed.tag, closed.attributes)
+
+    def open_element(self, tag, attributes):
+        parent = self.unfinished[-1] if self.unfinished else None
+        node = Element(tag, attributes, parent)
+        if parent:
+            parent.children.append(node)
+        else:
+            self.index.root = node
+        self.index.add(node)
+        self.unfinished.append(node)
+        if tag == "p":
+            self.open_p += 1
+        self.update_mode()
+
+    def close_element(self):
+        node = self.unfinished.pop()
+        if node.tag == "p":
+            self.open_p -= 1
+        self.update_mode()
+        return node
+
+    def update_mode(self):
+        # the root is always <html>, so only the first two open elements
+        # decide which implicit tags are needed
+        depth = len(self.unfinished)
+        if depth == 0:
+            self.mode = "initial"
+        elif depth == 1:
+            self.mode = "before head"
+        elif depth == 2 and self.unfinished[1].tag == "head":
+            self.mode = "in head"
+        else:
+            self.mode = "in content"
 
     def implicit_tags(self, tag):
         while True:
-            open_tags = [node.tag for node in self.unfinished]
-            if open_tags == [] and tag != "html":
+            if self.mode == "initial" and tag != "html":
                 self.add_tag("html")
-            elif open_tags == ["html"] and tag not in ["head", "body", "/html"]:
+            elif self.mode == "before head" and \
+                    tag not in ["head", "body", "/html"]:
                 if tag in self.HEAD_TAGS:
                     self.add_tag("head")
                 else:
                     self.add_tag("body")
-            elif (
-                open_tags == ["html", "head"] and tag not in [
-                    "/head"] + self.HEAD_TAGS
-            ):
+            elif self.mode == "in head" and \
+                    tag != "/head" and tag not in self.HEAD_TAGS:
                 self.add_tag("/head")
             else:
                 break
@@ -311,11 +1057,7 @@ class HTMLParser:
     def finish(self):
         if len(self.unfinished) == 0:
             self.add_tag("html")
-        while len(self.unfinished) > 1:
-            node = self.unfinished.pop()
-            parent = self.unfinished[-1]
-            parent.children.append(node)
-        return self.unfinished.pop()
+        return self.unfinished[0]
 
 
 def print_tree(node, indent=0):
@@ -324,6 +1066,28 @@ def print_tree(node, indent=0):
         print_tree(child, indent + 2)
 
 
+def memory_report(tree):
+    nodes = tree_to_list(tree, [])
+    seen = set()
+    total = 0
+    for node in nodes:
+        parts = [node, node.children]
+        if isinstance(node, Text):
+            parts.append(node.text)
+        else:
+            parts.append(node.attributes)
+            parts.extend(node.attributes.values())
+        for part in parts:
+            if id(part) not in seen:
+                seen.add(id(part))
+                total += sys.getsizeof(part)
+    return {
+        "nodes": len(nodes),
+        "bytes": total,
+        "bytes_per_node": total / len(nodes),
+    }
+
+
 def show(body):
     in_angle = False
     for c in body:
@@ -342,14 +1106,218 @@ SCROLL_STEP = 100
 FONTS = {}
 
 
+MEASURE_CACHE_SIZE = 64 * 1024
+
+
+class MeasureCache:
+    def __init__(self, max_entries=MEASURE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def measure(self, font, text):
+        key = (font.name, text)
+        width = self.entries.get(key)
+        if width is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return width
+        self.misses += 1
+        width = font.measure(text)
+        self.entries[key] = width
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return width
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+MEASURE_CACHE = MeasureCache()
+
+
+def measure(font, text):
+    return MEASURE_CACHE.measure(font, text)
+
+
+class FontRecord:
+    def __init__(self, font):
+        self.font = font
+        self.name = font.name
+        metrics = font.metrics()
+        self.ascent = metrics["ascent"]
+        self.descent = metrics["descent"]
+        self.linespace = metrics["linespace"]
+        self.space_width = font.measure(" ")
+
+    def measure(self, text):
+        return self.font.measure(text)
+
+    def __repr__(self):
+        return "FontRecord(name={}, ascent={}, descent={}, linespace={})" \
+            .format(self.name, self.ascent, self.descent, self.linespace)
+
+
+class TkFontBackend:
+    def load_font(self, size, weight, slant):
+        return tkinter.font.Font(size=size, weight=weight, slant=slant)
+
+
+class FixedFont:
+    def __init__(self, size, weight, slant, advance, ascent, descent):
+        self.name = "fixed-{}-{}-{}".format(size, weight, slant)
+        self.advance = max(1, round(size * advance))
+        self.ascent = round(size * ascent)
+        self.descent = round(size * descent)
+
+    def measure(self, text):
+        return len(text) * self.advance
+
+    def metrics(self):
+        return {
+            "ascent": self.ascent,
+            "descent": self.descent,
+            "linespace": self.ascent + self.descent,
+        }
+
+
+class FixedFontBackend:
+    def __init__(self, advance=0.6, ascent=1.0, descent=0.3):
+        self.advance = advance
+        self.ascent = ascent
+        self.descent = descent
+
+    def load_font(self, size, weight, slant):
+        return FixedFont(size, weight, slant,
+                         self.advance, self.ascent, self.descent)
+
+
+class GlyphTableFont:
+    def __init__(self, name, entry, scale=1):
+        self.name = name
+        self.entry = entry
+        self.scale = scale
+        self.advances = entry["advances"]
+        self.default_advance = entry["default_advance"]
+
+    def measure(self, text):
+        advances = self.advances
+        default = self.default_advance
+        width = sum([advances.get(c, default) for c in text])
+        if self.scale != 1:
+            width = round(width * self.scale)
+        return width
+
+    def metrics(self):
+        return {
+            "ascent": round(self.entry["ascent"] * self.scale),
+            "descent": round(self.entry["descent"] * self.scale),
+            "linespace": round(self.entry["linespace"] * self.scale),
+        }
+
+
+class GlyphTableBackend:
+    def __init__(self, table):
+        assert table, "Glyph table has no fonts"
+        self.table = table
+        # fonts a page asked for that the table had to approximate
+        self.missing = set()
+
+    def load_font(self, size, weight, slant):
+        name = "{} {} {}".format(size, weight, slant)
+        if name in self.table:
+            return GlyphTableFont("glyphs-" + name, self.table[name])
+        self.missing.add((size, weight, slant))
+        # scale the nearest size, preferring the same weight and slant
+        def distance(key):
+            other_size, other_weight, other_slant = key.split(" ")
+            return (other_weight != weight, other_slant != slant,
+                    abs(int(other_size) - size))
+        nearest = min(self.table, key=distance)
+        scale = size / int(nearest.split(" ")[0])
+        return GlyphTableFont("glyphs-" + name, self.table[nearest], scale)
+
+
+class RecordingFontBackend:
+    def __init__(self, backend):
+        self.backend = backend
+        self.keys = {}
+
+    def load_font(self, size, weight, slant):
+        self.keys[(size, weight, slant)] = None
+        return self.backend.load_font(size, weight, slant)
+
+
+GLYPH_TABLE_CHARS = [chr(c) for c in range(0x20, 0x7f)]
+
+
+def capture_glyph_table(backend, keys, chars=GLYPH_TABLE_CHARS):
+    table = {}
+    for size, weight, slant in keys:
+        font = backend.load_font(size, weight, slant)
+        advances = {c: font.measure(c) for c in chars}
+        metrics = font.metrics()
+        table["{} {} {}".format(size, weight, slant)] = {
+            "ascent": metrics["ascent"],
+            "descent": metrics["descent"],
+            "linespace": metrics["linespace"],
+            "advances": advances,
+            "default_advance": font.measure("?"),
+        }
+    return table
+
+
+def capture_page_glyph_table(backend, url, chars=GLYPH_TABLE_CHARS):
+    recorder = RecordingFontBackend(backend)
+    previous = FONT_BACKEND
+    set_font_backend(recorder)
+    try:
+        Tab().load(url)
+    finally:
+        set_font_backend(previous)
+    return capture_glyph_table(backend, list(recorder.keys), chars)
+
+
+def load_glyph_table(path):
+    with open(path) as f:
+        return GlyphTableBackend(json.load(f))
+
+
+FONT_BACKEND = TkFontBackend()
+
+
+def set_font_backend(backend):
+    global FONT_BACKEND
+    FONT_BACKEND = backend
+    FONTS.clear()
+    STYLE_FONTS.clear()
+    MEASURE_CACHE.entries.clear()
+
+
 def get_font(size, weight, slant):
     key = (size, weight, slant)
     if key not in FONTS:
-        font = tkinter.font.Font(size=size, weight=weight, slant=slant)
-        FONTS[key] = font
+        font = FONT_BACKEND.load_font(size, weight, slant)
+        FONTS[key] = FontRecord(font)
     return FONTS[key]
 
 
+STYLE_FONTS = {}
+
+
+def style_font(style):
+    key = (style["font-size"], style["font-weight"], style["font-style"])
+    if key not in STYLE_FONTS:
+        size, weight, slant = key
+        if slant == "normal":
+            slant = "roman"
+        size = int(float(size[:-2]) * .75)
+        STYLE_FONTS[key] = get_font(size, weight, slant)
+    return STYLE_FONTS[key]
+
+
 class DocumentLayout:
     def __init__(self, node):
         self.node = node
@@ -364,6 +1332,39 @@ class DocumentLayout:
 # mypy typechecker for python
 
 
+def shift_layout(obj, dy):
+    obj.y += dy
+    for child in obj.children:
+        shift_layout(child, dy)
+
+
+def child_at(children, pos, axis):
+    lo, hi = 0, len(children)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if getattr(children[mid], axis) <= pos:
+            lo = mid + 1
+        else:
+            hi = mid
+    return children[lo - 1] if lo else None
+
+
+def hit_test(document, x, y):
+    # block and line children are stacked top to bottom and words run
+    # left to right, so the boxes under a point form one root-to-leaf path
+    objs = []
+    obj = document
+    while obj:
+        if obj.x <= x < obj.x + obj.width \
+           and obj.y <= y < obj.y + obj.height:
+            objs.append(obj)
+        if isinstance(obj, LineLayout):
+            obj = child_at(obj.children, x, "x")
+        else:
+            obj = child_at(obj.children, y, "y")
+    return objs
+
+
 class BlockLayout:
     def __init__(self, node, parent, previous):
         self.node = node
@@ -374,31 +1375,69 @@ class BlockLayout:
         self.y = None
         self.width = None
         self.height = None
+        # dirty: this block's children must be rebuilt
+        # children_dirty: some descendant block is dirty
+        self.dirty = True
+        self.children_dirty = False
+        self.document = parent.document
+        self.document.blocks[node] = self
 
     def layout(self):
         self.width = self.parent.width
         self.x = self.parent.x
 
         if self.previous:
-            self.y = self.previous.y + self.previous.height
+            y = self.previous.y + self.previous.height
         else:
-            self.y = self.parent.y
+            y = self.parent.y
 
-        mode = layout_mode(self.node)
-        if mode == "block":
-            previous = None
-            for child in self.node.children:
-                next = BlockLayout(child, self, previous)
-                self.children.append(next)
-                previous = next
-        else:
-            self.new_line()
-            self.recurse(self.node)
+        if not self.dirty and not self.children_dirty:
+            if y != self.y:
+                shift_layout(self, y - self.y)
+            return
+        self.y = y
+
+        if self.dirty:
+            self.unregister_children()
+            self.children = []
+            mode = layout_mode(self.node)
+            if mode == "block":
+                previous = None
+                for child in self.node.children:
+                    next = BlockLayout(child, self, previous)
+                    self.children.append(next)
+                    previous = next
+            else:
+                self.new_line()
+                self.recurse(self.node)
 
         for child in self.children:
             child.layout()
 
         self.height = sum([child.height for child in self.children])
+        self.dirty = False
+        self.children_dirty = False
+
+    def unregister(self):
+        if self.document.blocks.get(self.node) is self:
+            del self.document.blocks[self.node]
+        self.unregister_children()
+
+    def unregister_children(self):
+        inlines = self.document.inlines
+        for child in self.children:
+            if isinstance(child, BlockLayout):
+                child.unregister()
+                continue
+            for obj in child.children:
+                if isinstance(obj, TextLayout):
+                    nodes = obj.nodes
+                else:
+                    nodes = [obj.node]
+                for node in nodes:
+                    objs = inlines.get(node)
+                    if objs and objs[0].parent.parent is self:
+                        del inlines[node]
 
     def recurse(self, node):
         if isinstance(node, Text):
@@ -420,24 +1459,26 @@ class BlockLayout:
         self.children.append(new_line)
 
     def get_font(self, node):
-        weight = node.style["font-weight"]
-        style = node.style["font-style"]
-        if style == "normal":
-            style = "roman"
-        size = int(float(node.style["font-size"][:-2]) * .75)
-        return get_font(size, weight, style)
+        return style_font(node.style)
 
     def text(self, node):
         font = self.get_font(node)
+        color = node.style["color"]
         for word in node.text.split():
-            w = font.measure(word)
+            w = measure(font, word)
             if self.cursor_x + w > self.width:
                 self.new_line()
-            line = self.children[-1]
-            text = TextLayout(node, word, line, self.previous_word)
-            line.children.append(text)
-            self.previous_word = text
-            self.cursor_x += w + font.measure(" ")
+            run = self.previous_word
+            # consecutive words on a line that look the same share one run
+            if isinstance(run, TextLayout) and run.font is font \
+               and run.color == color:
+                run.add_word(node, word)
+            else:
+                line = self.children[-1]
+                run = TextLayout(node, word, line, self.previous_word)
+                line.children.append(run)
+                self.previous_word = run
+            self.cursor_x += w + font.space_width
 
     def input(self, node):
         w = INPUT_WIDTH_PX
@@ -448,7 +1489,7 @@ class BlockLayout:
         line.children.append(input)
         self.previous_word = input
         font = self.get_font(node)
-        self.cursor_x += w + font.measure(" ")
+        self.cursor_x += w + font.space_width
 
     def paint(self, display_list):
         bgcolor = self.node.style.get("background-color",
@@ -481,10 +1522,15 @@ class DocumentLayout:
         self.parent = None
         self.previous = None
         self.children = []
+        self.document = self
+        self.blocks = {}
+        self.inlines = {}
 
     def layout(self):
-        child = BlockLayout(self.node, self, None)
-        self.children.append(child)
+        if not self.children:
+            child = BlockLayout(self.node, self, None)
+            self.children.append(child)
+        child = self.children[0]
 
         self.width = WIDTH - 2*HSTEP
         self.x = HSTEP
@@ -492,6 +1538,22 @@ class DocumentLayout:
         child.layout()
         self.height = child.height + 2*VSTEP
 
+    def layout_objects(self, node):
+        objs = list(self.inlines.get(node, ()))
+        if node in self.blocks:
+            objs.insert(0, self.blocks[node])
+        return objs
+
+    def mark_dirty(self, node):
+        while node not in self.blocks:
+            node = node.parent
+        block = self.blocks[node]
+        block.dirty = True
+        obj = block.parent
+        while isinstance(obj, BlockLayout):
+            obj.children_dirty = True
+            obj = obj.parent
+
     def paint(self, display_list):
         self.children[0].paint(display_list)
 
@@ -506,17 +1568,22 @@ class DrawText:
         self.text = text
         self.font = font
         self.color = color
-        self.bottom = y1 + font.metrics("linespace")
+        self.bottom = y1 + font.linespace
 
-    def execute(self, scroll, canvas):
-        canvas.create_text(
+    def execute(self, scroll, canvas, tags=()):
+        return canvas.create_text(
             self.left, self.top - scroll,
             text=self.text,
-            font=self.font,
+            font=self.font.font,
             anchor='nw',
             fill=self.color,
+            tags=tags,
         )
 
+    def update(self, canvas, item):
+        canvas.itemconfigure(item, text=self.text, font=self.font.font,
+                             fill=self.color)
+
     def __repr__(self):
         return "DrawText(top={} left={} bottom={} text={} font={})".format(
             self.top, self.left, self.bottom, self.text, self.font)
@@ -530,22 +1597,57 @@ class DrawRect:
         self.right = x2
         self.color = color
 
-    def execute(self, scroll, canvas):
-        canvas.create_rectangle(
+    def execute(self, scroll, canvas, tags=()):
+        return canvas.create_rectangle(
             self.left, self.top - scroll,
             self.right, self.bottom - scroll,
             width=0,
             fill=self.color,
+            tags=tags,
         )
 
+    def update(self, canvas, item):
+        canvas.itemconfigure(item, fill=self.color)
+
     def __repr__(self):
         return "DrawRect(top={} left={} bottom={} right={} color={})".format(
             self.top, self.left, self.bottom, self.right, self.color)
 
 
+class DisplayListIndex:
+    def __init__(self, display_list):
+        self.display_list = display_list
+        # commands are bucketed by height class, so within a bucket only
+        # tops up to one class height above the window can still reach it
+        levels = {}
+        for i, cmd in enumerate(display_list):
+            height = max(cmd.bottom - cmd.top, 0)
+            level = int(height).bit_length()
+            levels.setdefault(level, []).append((cmd.top, i))
+        self.buckets = []
+        for level, entries in levels.items():
+            entries.sort()
+            tops = [top for top, i in entries]
+            indices = [i for top, i in entries]
+            self.buckets.append((1 << level, tops, indices))
+
+    def visible(self, top, bottom):
+        found = []
+        for max_height, tops, indices in self.buckets:
+            lo = bisect.bisect_left(tops, top - max_height)
+            hi = bisect.bisect_right(tops, bottom)
+            for i in indices[lo:hi]:
+                if self.display_list[i].bottom >= top:
+                    found.append(i)
+        found.sort()
+        return found
+
+
 class TagSelector:
     def __init__(self, tag):
         self.tag = tag
+        self.tags = [tag]
+        self.rightmost_tag = tag
         self.priority = 1
 
     def matches(self, node):
@@ -560,6 +1662,8 @@ class DescendantSelector:
     def __init__(self, ancestor, descendant):
         self.ancestor = ancestor
         self.descendant = descendant
+        self.tags = ancestor.tags + descendant.tags
+        self.rightmost_tag = descendant.rightmost_tag
         self.priority = ancestor.priority + descendant.priority
 
     def matches(self, node):
@@ -602,28 +1706,115 @@ def compute_style(node, property, value):
         return value
 
 
+ANCESTOR_FILTER_SIZE = 1024
+
+
+class AncestorFilter:
+    def __init__(self):
+        self.counts = [0] * ANCESTOR_FILTER_SIZE
+
+    def slots(self, tag):
+        h = hash(tag)
+        return [h % ANCESTOR_FILTER_SIZE,
+                (h >> 10) % ANCESTOR_FILTER_SIZE]
+
+    def push(self, tag):
+        for slot in self.slots(tag):
+            self.counts[slot] += 1
+
+    def pop(self, tag):
+        for slot in self.slots(tag):
+            self.counts[slot] -= 1
+
+    def may_contain(self, slots):
+        for slot in slots:
+            if not self.counts[slot]:
+                return False
+        return True
+
+
+class RuleIndex:
+    def __init__(self, rules):
+        # rules arrive in cascade order, and each bucket keeps that order
+        self.by_tag = {}
+        slots = AncestorFilter().slots
+        for selector, body in rules:
+            required = []
+            for tag in selector.tags[:-1]:
+                required.extend(slots(tag))
+            self.by_tag.setdefault(selector.rightmost_tag, []).append(
+                (selector, body, required))
+
+    def candidates(self, node):
+        if not isinstance(node, Element):
+            return []
+        return self.by_tag.get(node.tag, [])
+
+
 def style(node, rules):
-    node.style = {}
+    style_tree(node, RuleIndex(rules), AncestorFilter(), {}, None)
+
+
+def restyle(node, rules):
+    ancestors = AncestorFilter()
+    parent = node.parent
+    while parent:
+        ancestors.push(parent.tag)
+        parent = parent.parent
+    style_tree(node, rules, ancestors, {}, None)
+
+
+def has_dirty_ancestor(node):
+    node = node.parent
+    while node:
+        if node.style_dirty:
+            return True
+        node = node.parent
+    return False
+
+
+def style_tree(node, rules, ancestors, shared, parent_key):
+    # selectors only look at tags, so elements with the same tag, inline
+    # style and ancestor chain always compute the same style
+    if isinstance(node, Element):
+        key = (parent_key, node.tag, node.attributes.get("style"))
+    else:
+        key = (parent_key, None, None)
+    if key not in shared:
+        computed = compute_node_style(node, rules, ancestors)
+        shared[key] = (len(shared), types.MappingProxyType(computed))
+    style_key, node.style = shared[key]
+
+    if isinstance(node, Element):
+        ancestors.push(node.tag)
+        for child in node.children:
+            style_tree(child, rules, ancestors, shared, style_key)
+        ancestors.pop(node.tag)
+
+
+def compute_node_style(node, rules, ancestors):
+    style = {}
     for property, default_value in INHERITED_PROPERTIES.items():
         if node.parent:
-            node.style[property] = node.parent.style[property]
+            style[property] = node.parent.style[property]
         else:
-            node.style[property] = default_value
-    for selector, body in rules:
+            style[property] = default_value
+    for selector, body, required in rules.candidates(node):
+        if not ancestors.may_contain(required):
+            continue
         if not selector.matches(node):
             continue
         for property, value in body.items():
             computed_value = compute_style(node, property, value)
             if not computed_value:
                 continue
-            node.style[property] = computed_value
+            style[property] = computed_value
     if isinstance(node, Element) and "style" in node.attributes:
-        pairs = CSSParser(node.attributes["style"]).body()
+        pairs = parse_declarations(node.attributes["style"])
         for property, value in pairs.items():
             computed_value = compute_style(node, property, value)
-            node.style[property] = computed_value
-    for child in node.children:
-        style(child, rules)
+            style[property] = computed_value
+    return style
 
 
 def cascade_priority(rule):
@@ -631,28 +1822,51 @@ def cascade_priority(rule):
     return selector.priority
 
 
+CSS_WORD_PATTERN = r"(?:[^\W_]|[#.%-])+"
+# a single character class is several times faster than the alternation
+# above; it also lets "_" through, so blocks containing one are reparsed
+# with the exact patterns
+CSS_FAST_WORD_PATTERN = r"[\w#.%-]+"
+CSS_PAIR_PATTERN = r"({0})\s*:\s*({0})"
+CSS_SELECTOR_PATTERN = r"({0}(?:\s+{0})*)\s*"
+CSS_WHITESPACE = re.compile(r"\s*")
+CSS_WORD = re.compile(CSS_WORD_PATTERN)
+CSS_PAIR = re.compile(
+    CSS_PAIR_PATTERN.format(CSS_WORD_PATTERN) + r"\s*")
+CSS_SELECTOR = re.compile(CSS_SELECTOR_PATTERN.format(CSS_WORD_PATTERN))
+CSS_DECLARATIONS = re.compile(r"(?:{0}\s*;\s*)*(?:{0}\s*)?".format(
+    CSS_PAIR_PATTERN.format(CSS_FAST_WORD_PATTERN)))
+CSS_DECLARATIONS_PAIR = re.compile(
+    CSS_PAIR_PATTERN.format(CSS_FAST_WORD_PATTERN))
+CSS_RULE = re.compile(
+    CSS_SELECTOR_PATTERN.format(CSS_FAST_WORD_PATTERN) +
+    r"\{\s*([^}]*)\}")
+
+
+def make_selector(words):
+    out = TagSelector(words[0].lower())
+    for tag in words[1:]:
+        out = DescendantSelector(out, TagSelector(tag.lower()))
+    return out
+
+
 class CSSParser:
     def __init__(self, s):
         self.s = s
         self.i = 0
 
     def whitespace(self):
-        while self.i < len(self.s) and self.s[self.i].isspace():
-            self.i += 1
+        self.i = CSS_WHITESPACE.match(self.s, self.i).end()
 
     def literal(self, literal):
         assert self.i < len(self.s) and self.s[self.i] == literal
         self.i += 1
 
     def word(self):
-        start = self.i
-        while self.i < len(self.s):
-            if self.s[self.i].isalnum() or self.s[self.i] in "#-.%":
-                self.i += 1
-            else:
-                break
-        assert self.i > start
-        return self.s[start:self.i]
+        m = CSS_WORD.match(self.s, self.i)
+        assert m
+        self.i = m.end()
+        return m.group()
 
     def pair(self):
         prop = self.word()
@@ -663,63 +1877,129 @@ class CSSParser:
         return prop.lower(), val
 
     def ignore_until(self, chars):
-        while self.i < len(self.s):
-            if self.s[self.i] in chars:
-                return self.s[self.i]
-            else:
-                self.i += 1
+        found = [self.s.find(c, self.i) for c in chars]
+        found = [i for i in found if i != -1]
+        if not found:
+            self.i = len(self.s)
+            return None
+        self.i = min(found)
+        return self.s[self.i]
+
+    # body() and parse() take whole well-formed blocks with one regex and
+    # only fall back to ignore_until on malformed input; the characters a
+    # partial match skips can never be ; or }, so they recover to the same
+    # place as failing token by token would.
+    def declarations(self, text):
+        return {prop.lower(): val
+                for prop, val in CSS_DECLARATIONS_PAIR.findall(text)}
 
     def body(self):
+        s = self.s
+        m = CSS_DECLARATIONS.match(s, self.i)
+        end = m.end()
+        if (end == len(s) or s[end] == "}") and "_" not in m.group():
+            self.i = end
+            return self.declarations(m.group())
+
         pairs = {}
-        while self.i < len(self.s) and self.s[self.i] != "}":
-            try:
-                prop, val = self.pair()
-                pairs[prop.lower()] = val
-                self.whitespace()
-                self.literal(";")
-                self.whitespace()
-            except AssertionError:
-                why = self.ignore_until([";", "}"])
-                if why == ";":
-                    self.literal(";")
+        while self.i < len(s) and s[self.i] != "}":
+            m = CSS_PAIR.match(s, self.i)
+            if m:
+                pairs[m.group(1).lower()] = m.group(2)
+                self.i = m.end()
+                if self.i < len(s) and s[self.i] == ";":
+                    self.i += 1
                     self.whitespace()
-                else:
-                    break
+                    continue
+            why = self.ignore_until([";", "}"])
+            if why == ";":
+                self.i += 1
+                self.whitespace()
+            else:
+                break
         return pairs
 
     def selector(self):
-        out = TagSelector(self.word().lower())
-        self.whitespace()
-        while self.i < len(self.s) and self.s[self.i] != "{":
-            tag = self.word()
-            descendant = TagSelector(tag.lower())
-            out = DescendantSelector(out, descendant)
-            self.whitespace()
-        return out
+        m = CSS_SELECTOR.match(self.s, self.i)
+        assert m and (m.end() == len(self.s) or self.s[m.end()] == "{")
+        self.i = m.end()
+        return make_selector(m.group(1).split())
 
     def parse(self):
         rules = []
-        while self.i < len(self.s):
-            try:
-                self.whitespace()
-                selector = self.selector()
-                self.literal("{")
+        s = self.s
+        while self.i < len(s):
+            self.whitespace()
+            m = CSS_RULE.match(s, self.i)
+            if m and CSS_DECLARATIONS.fullmatch(m.group(2)) and \
+                    "_" not in m.group():
+                selector = make_selector(m.group(1).split())
+                rules.append((selector, self.declarations(m.group(2))))
+                self.i = m.end()
+                continue
+
+            m = CSS_SELECTOR.match(s, self.i)
+            if m and m.end() < len(s) and s[m.end()] == "{":
+                selector = make_selector(m.group(1).split())
+                self.i = m.end() + 1
                 self.whitespace()
                 body = self.body()
-                self.literal("}")
-                rules.append((selector, body))
-            except AssertionError:
-                why = self.ignore_until(["}"])
-                if why == "}":
-                    self.literal("}")
-                    self.whitespace()
-                else:
-                    break
+                if self.i < len(s):
+                    self.i += 1
+                    rules.append((selector, body))
+                    continue
+            why = self.ignore_until(["}"])
+            if why == "}":
+                self.i += 1
+                self.whitespace()
+            else:
+                break
         return rules
 
 
+CSS_CACHE_SIZE = 512
+
+
+class CSSCache:
+    def __init__(self, max_entries=CSS_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, kind, text, parse):
+        key = (kind, hashlib.sha1(text.encode("utf8")).digest())
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        value = parse()
+        self.entries[key] = value
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return value
+
+
+CSS_CACHE = CSSCache()
+
+
+def parse_stylesheet(text):
+    return CSS_CACHE.lookup(
+        "sheet", text, lambda: tuple(CSSParser(text).parse()))
+
+
+def parse_declarations(text):
+    return CSS_CACHE.lookup(
+        "declarations", text,
+        lambda: types.MappingProxyType(CSSParser(text).body()))
+
+
 class Browser:
-    def __init__(self):
+    def __init__(self, cache_dir=None):
+        if cache_dir:
+            CACHE.disk = DiskCache(cache_dir)
+
         self.window = tkinter.Tk()
         self.canvas = tkinter.Canvas(
             self.window,
@@ -738,6 +2018,8 @@ class Browser:
         self.active_tab = None
         self.focus = None
         self.address_bar = ""
+        self.chrome_state = None
+        self.content_tab = None
 
     def handle_down(self, e):
         self.tabs[self.active_tab].scrolldown()
@@ -779,38 +2061,70 @@ class Browser:
             self.draw()
 
     def load(self, url):
-        new_tab = Tab()
-        new_tab.load(url)
+        new_tab = Tab(self)
+        previous = self.active_tab
         self.active_tab = len(self.tabs)
         self.tabs.append(new_tab)
+        try:
+            new_tab.load(url)
+        except BaseException:
+            self.tabs.pop()
+            self.active_tab = previous
+            if self.tabs:
+                self.draw()
+            raise
         self.draw()
 
     def draw(self):
-        self.canvas.delete("all")
-        self.tabs[self.active_tab].draw(self.canvas)
+        tab = self.tabs[self.active_tab]
+        tab.render_if_needed()
+        self.draw_chrome()
+        if self.content_tab is not tab:
+            self.canvas.delete("content", "caret")
+            tab.forget_canvas()
+            self.content_tab = tab
+        tab.draw(self.canvas)
+
+    def draw_chrome(self):
+        tab = self.tabs[self.active_tab]
+        state = (len(self.tabs), self.active_tab, self.focus,
+                 self.address_bar, tab.url, tab.secure)
+        if state == self.chrome_state:
+            return
+        self.chrome_state = state
+        self.canvas.delete("chrome")
         self.canvas.create_rectangle(0, 0, WIDTH, CHROME_PX,
-                                     fill="white", outline="black")
+                                     fill="white", outline="black",
+                                     tags="chrome")
 
         tabfont = get_font(20, "normal", "roman")
         for i, tab in enumerate(self.tabs):
             name = "Tab {}".format(i)
             x1, x2 = 40 + 80 * i, 120 + 80 * i
-            self.canvas.create_line(x1, 0, x1, 40, fill="black")
-            self.canvas.create_line(x2, 0, x2, 40, fill="black")
+            self.canvas.create_line(x1, 0, x1, 40, fill="black",
+                                    tags="chrome")
+            self.canvas.create_line(x2, 0, x2, 40, fill="black",
+                                    tags="chrome")
             self.canvas.create_text(x1 + 10, 10, anchor="nw", text=name,
-                                    font=tabfont, fill="black")
+                                    font=tabfont.font, fill="black",
+                                    tags="chrome")
             if i == self.active_tab:
-                self.canvas.create_line(0, 40, x1, 40, fill="black")
-                self.canvas.create_line(x2, 40, WIDTH, 40, fill="black")
+                self.canvas.create_line(0, 40, x1, 40, fill="black",
+                                        tags="chrome")
+                self.canvas.create_line(x2, 40, WIDTH, 40, fill="black",
+                                        tags="chrome")
 
         buttonfont = get_font(30, "normal", "roman")
         self.canvas.create_rectangle(10, 10, 30, 30,
-                                     outline="black", width=1)
+                                     outline="black", width=1,
+                                     tags="chrome")
         self.canvas.create_text(11, 0, anchor="nw", text="+",
-                                font=buttonfont, fill="black")
+                                font=buttonfont.font, fill="black",
+                                tags="chrome")
 
         self.canvas.create_rectangle(40, 50, WIDTH - 10, 90,
-                                     outline="black", width=1)
+                                     outline="black", width=1,
+                                     tags="chrome")
         if self.focus == "address bar":
             address_bar_text = self.address_bar
 
@@ -818,20 +2132,23 @@ class Browser:
                 address_bar_text + "\N{lock}" + address_bar_text
             self.canvas.create_text(
                 55, 55, anchor='nw', text=address_bar_text,
-                font=buttonfont, fill="black")
-            w = buttonfont.measure(self.address_bar)
-            self.canvas.create_line(55 + w, 55, 55 + w, 85, fill="black")
+                font=buttonfont.font, fill="black", tags="chrome")
+            w = measure(buttonfont, self.address_bar)
+            self.canvas.create_line(55 + w, 55, 55 + w, 85, fill="black",
+                                    tags="chrome")
         else:
             url = self.tabs[self.active_tab].url
             if self.tabs[self.active_tab].secure:
                 url = "\N{lock}" + url
             self.canvas.create_text(55, 55, anchor='nw', text=url,
-                                    font=buttonfont, fill="black")
+                                    font=buttonfont.font, fill="black",
+                                    tags="chrome")
 
         self.canvas.create_rectangle(10, 50, 35, 90,
-                                     outline="black", width=1)
+                                     outline="black", width=1,
+                                     tags="chrome")
         self.canvas.create_polygon(
-            15, 70, 30, 55, 30, 85, fill='black')
+            15, 70, 30, 55, 30, 85, fill='black', tags="chrome")
 
 
 class LineLayout:
@@ -840,6 +2157,7 @@ class LineLayout:
         self.parent = parent
         self.previous = previous
         self.children = []
+        self.document = parent.document
         self.x = None
         self.y = None
         self.width = None
@@ -861,13 +2179,16 @@ class LineLayout:
             self.height = 0
             return
 
-        max_ascent = max([word.font.metrics("ascent")
-                          for word in self.children])
+        max_ascent = max_descent = 0
+        for word in self.children:
+            font = word.font
+            if font.ascent > max_ascent:
+                max_ascent = font.ascent
+            if font.descent > max_descent:
+                max_descent = font.descent
         baseline = self.y + 1.25 * max_ascent
         for word in self.children:
-            word.y = baseline - word.font.metrics("ascent")
-        max_descent = max([word.font.metrics("descent")
-                           for word in self.children])
+            word.y = baseline - word.font.ascent
         self.height = 1.25 * (max_ascent + max_descent)
 
     def paint(self, display_list):
@@ -882,7 +2203,8 @@ class LineLayout:
 class TextLayout:
     def __init__(self, node, word, parent, previous):
         self.node = node
-        self.word = word
+        self.words = [word]
+        self.nodes = [node]
         self.children = []
         self.parent = parent
         self.previous = previous
@@ -890,31 +2212,48 @@ class TextLayout:
         self.y = None
         self.width = None
         self.height = None
-        self.font = None
+        self.font = style_font(node.style)
+        self.color = node.style["color"]
+        self.document = parent.document
+        self.document.inlines.setdefault(node, []).append(self)
 
-    def layout(self):
-        weight = self.node.style["font-weight"]
-        style = self.node.style["font-style"]
-        if style == "normal":
-            style = "roman"
-        size = int(float(self.node.style["font-size"][:-2]) * .75)
-        self.font = get_font(size, weight, style)
+    def add_word(self, node, word):
+        if node is not self.nodes[-1]:
+            self.document.inlines.setdefault(node, []).append(self)
+        self.words.append(word)
+        self.nodes.append(node)
 
+    def layout(self):
         # Do not set self.y!!!
-        self.width = self.font.measure(self.word)
+        space = self.font.space_width
+        self.offsets = []
+        self.widths = []
+        offset = 0
+        for word in self.words:
+            w = measure(self.font, word)
+            self.offsets.append(offset)
+            self.widths.append(w)
+            offset += w + space
+        self.width = offset - space
+        self.text = " ".join(self.words)
 
         if self.previous:
-            space = self.previous.font.measure(" ")
+            space = self.previous.font.space_width
             self.x = self.previous.x + space + self.previous.width
         else:
             self.x = self.parent.x
 
-        self.height = self.font.metrics("linespace")
+        self.height = self.font.linespace
+
+    def node_at(self, x):
+        i = bisect.bisect_right(self.offsets, x - self.x) - 1
+        if i >= 0 and x - self.x < self.offsets[i] + self.widths[i]:
+            return self.nodes[i]
+        return None
 
     def paint(self, display_list):
-        color = self.node.style["color"]
         display_list.append(
-            DrawText(self.x, self.y, self.word, self.font, color))
+            DrawText(self.x, self.y, self.text, self.font, self.color))
 
     def __repr__(self):
         return ("TextLayout(x={}, y={}, width={}, height={}, " +
@@ -923,26 +2262,64 @@ class TextLayout:
 
 
 CHROME_PX = 100
+PROGRESSIVE_PAINT_INTERVAL = 0.1
+PAGE_STATE = [
+    "url", "secure", "scroll", "focus", "refer_policy", "allowed_origins",
+    "rules", "fetches", "nodes", "document", "index", "js", "rule_index",
+    "display_list", "display_index", "needs_render",
+]
+MAX_CANVAS_ITEMS = 5000
 
 
 class Tab:
-    def __init__(self):
+    def __init__(self, browser=None):
+        self.browser = browser
         self.history = []
         self.focus = None
         self.url = None
+        self.secure = False
+        self.scroll = 0
         self.refer_policy = None
+        self.document = None
+        self.display_list = []
+        self.display_index = DisplayListIndex(self.display_list)
+        self.dirty_nodes = []
+        self.needs_render = False
+        self.renders_avoided = 0
+        self.forget_canvas()
 
         with open("browser.css") as f:
-            self.default_style_sheet = CSSParser(f.read()).parse()
+            self.default_style_sheet = parse_stylesheet(f.read())
 
     def allowed_request(self, url):
         return self.allowed_origins == None or \
             url_origin(url) in self.allowed_origins
 
     def load(self, url, body=None):
-        headers, body, sec = request(url, self.url, body, self.refer_policy)
+        # a navigation that fails part-way leaves the current page in place
+        saved = {name: getattr(self, name, None) for name in PAGE_STATE}
+        history = list(self.history)
+        dirty_nodes = list(self.dirty_nodes)
+        try:
+            self.navigate(url, body)
+        except BaseException:
+            painted = self.display_list is not saved["display_list"]
+            for name, value in saved.items():
+                setattr(self, name, value)
+            self.history = history
+            self.dirty_nodes = dirty_nodes
+            if painted:
+                self.forget_canvas()
+                if self.browser:
+                    self.browser.draw()
+            raise
+
+    def navigate(self, url, body=None):
+        headers, chunks, sec = request_stream(
+            url, self.url, body, self.refer_policy)
         self.secure = sec
         self.scroll = 0
+        self.focus = None
         self.url = url
         self.history.append(url)
 
@@ -957,69 +2334,174 @@ class Tab:
         else:
             self.refer_policy = None
 
-        self.nodes = HTMLParser(body).parse()
+        self.rules = list(self.default_style_sheet)
+        self.fetches = {}
+        scanner = PreloadScanner(self.preload)
+        parser = HTMLParser()
+        last_paint = None
+        for chunk in chunks:
+            scanner.feed(chunk)
+            parser.feed(chunk)
+            # once the whole body is in, only the final render is needed
+            if not self.browser or chunks.complete or not parser.root():
+                continue
+            now = time.time()
+            if last_paint is None or \
+               now - last_paint >= PROGRESSIVE_PAINT_INTERVAL:
+                self.nodes = parser.root()
+                self.document = None
+                self.render()
+                self.browser.draw()
+                self.browser.canvas.update_idletasks()
+                last_paint = now
+        self.nodes = parser.close()
+        self.index = parser.index
 
         self.js = JSContext(self)
         scripts = [node.attributes["src"] for node
-                   in tree_to_list(self.nodes, [])
-                   if isinstance(node, Element)
-                   and node.tag == "script"
-                   and "src" in node.attributes]
+                   in self.index.elements("script", "src")]
+        links = [node.attributes["href"]
+                 for node in self.index.elements("link", "href")
+                 if node.attributes.get("rel") == "stylesheet"]
+
+        script_fetches = []
         for script in scripts:
             script_url = resolve_url(script, url)
             if not self.allowed_request(script_url):
                 print("Blocked script", script, "due to CSP")
                 continue
-            header, body, secure = request(
-                script_url, url, refer_policy=self.refer_policy)
-            self.secure = secure
-            try:
-                self.js.run(body)
-            except dukpy.JSRuntimeError as e:
-                print("Script", script, "crashed", e)
+            script_fetches.append((script, self.fetch(script_url)))
 
-        self.rules = self.default_style_sheet.copy()
-        links = [node.attributes["href"]
-                 for node in tree_to_list(self.nodes, [])
-                 if isinstance(node, Element)
-                 and node.tag == "link"
-                 and "href" in node.attributes
-                 and node.attributes.get("rel") == "stylesheet"]
+        style_fetches = []
         for link in links:
             style_url = resolve_url(link, url)
             if not self.allowed_request(style_url):
                 print("Blocked style", link, "due to CSP")
                 continue
+            style_fetches.append(self.fetch(style_url))
+
+        for script, fetch in script_fetches:
+            header, body, secure = fetch.result()
+            self.secure = secure
             try:
-                header, body, _ = request(style_url, url, self.refer_policy)
+                self.js.run(body)
+            except dukpy.JSRuntimeError as e:
+                print("Script", script, "crashed", e)
+
+        for fetch in style_fetches:
+            try:
+                header, body, _ = fetch.result()
             except:
                 continue
-            self.rules.extend(CSSParser(body).parse())
+            self.rules.extend(parse_stylesheet(body))
+        self.document = None
         self.render()
 
+    def fetch(self, url):
+        if url not in self.fetches:
+            self.fetches[url] = FETCHER.submit(
+                request, url, self.url, refer_policy=self.refer_policy)
+        return self.fetches[url]
+
+    def preload(self, src):
+        url = resolve_url(src, self.url)
+        if self.allowed_request(url):
+            self.fetch(url)
+
+    def invalidate(self, node):
+        node.style_dirty = True
+        self.dirty_nodes.append(node)
+
+    def set_needs_render(self):
+        if self.needs_render:
+            self.renders_avoided += 1
+        self.needs_render = True
+
+    def render_if_needed(self):
+        if self.needs_render:
+            self.render()
+
     def render(self):
-        style(self.nodes, sorted(self.rules, key=cascade_priority))
-        self.document = DocumentLayout(self.nodes)
+        self.needs_render = False
+        if self.document is None:
+            self.rule_index = RuleIndex(
+                sorted(self.rules, key=cascade_priority))
+            style_tree(self.nodes, self.rule_index, AncestorFilter(), {}, None)
+            self.document = DocumentLayout(self.nodes)
+        else:
+            for node in self.dirty_nodes:
+                if not node.style_dirty or has_dirty_ancestor(node):
+                    continue
+                restyle(node, self.rule_index)
+                self.document.mark_dirty(node)
+        for node in self.dirty_nodes:
+            node.style_dirty = False
+        self.dirty_nodes = []
         self.document.layout()
         self.display_list = []
         self.document.paint(self.display_list)
+        self.display_index = DisplayListIndex(self.display_list)
+
+    def forget_canvas(self):
+        self.canvas_list = None
+        self.canvas_items = {}
+        self.canvas_order = []
+        self.canvas_scroll = None
+        self.canvas_caret = None
+        self.canvas_stale = set()
 
     def draw(self, canvas):
-        for cmd in self.display_list:
-            if cmd.top > self.scroll + HEIGHT - CHROME_PX:
+        visible = self.display_index.visible(
+            self.scroll, self.scroll + HEIGHT - CHROME_PX)
+        if self.canvas_list is not self.display_list or \
+           len(self.canvas_items) + len(visible) > MAX_CANVAS_ITEMS:
+            canvas.delete("content")
+            self.canvas_list = self.display_list
+            self.canvas_items = {}
+            self.canvas_order = []
+            self.canvas_scroll = self.scroll
+        elif self.canvas_scroll != self.scroll:
+            canvas.move("content", 0, self.canvas_scroll - self.scroll)
+            self.canvas_scroll = self.scroll
+        for i in self.canvas_stale:
+            if i in self.canvas_items:
+                self.display_list[i].update(canvas, self.canvas_items[i])
+        self.canvas_stale = set()
+
+        # items already on the canvas only need to be scrolled; new ones
+        # are slotted in below the next command in paint order
+        created = False
+        for i in visible:
+            if i in self.canvas_items:
                 continue
-            if cmd.bottom < self.scroll:
-                continue
-            cmd.execute(self.scroll - CHROME_PX, canvas)
-
+            item = self.display_list[i].execute(
+                self.scroll - CHROME_PX, canvas, "content")
+            j = bisect.bisect(self.canvas_order, i)
+            if j < len(self.canvas_order):
+                canvas.tag_lower(
+                    item, self.canvas_items[self.canvas_order[j]])
+            self.canvas_items[i] = item
+            self.canvas_order.insert(j, i)
+            created = True
+        if created:
+            canvas.tag_raise("caret")
+            canvas.tag_raise("chrome")
+
+        caret = None
         if self.focus:
-            obj = [obj for obj in tree_to_list(self.document, [])
-                   if obj.node == self.focus and
-                   isinstance(obj, InputLayout)][0]
+            obj = [obj for obj in self.document.layout_objects(self.focus)
+                   if isinstance(obj, InputLayout)][0]
             text = self.focus.attributes.get("value", "")
-            x = obj.x + obj.font.measure(text)
+            x = obj.x + measure(obj.font, text)
             y = obj.y - self.scroll + CHROME_PX
-            canvas.create_line(x, y, x, y + obj.height)
+            caret = (x, y, obj.height)
+        if caret != self.canvas_caret:
+            canvas.delete("caret")
+            if caret:
+                x, y, height = caret
+                canvas.create_line(x, y, x, y + height, tags="caret")
+                canvas.tag_raise("chrome")
+            self.canvas_caret = caret
 
     def scrolldown(self):
         max_y = self.document.height - (HEIGHT - CHROME_PX)
@@ -1028,12 +2510,17 @@ class Tab:
     def click(self, x, y):
         self.focus = None
         y += self.scroll
-        objs = [obj for obj in tree_to_list(self.document, [])
-                if obj.x <= x < obj.x + obj.width
-                and obj.y <= y < obj.y + obj.height]
-        if not objs:
+        objs = hit_test(self.document, x, y)
+        elt = None
+        for obj in reversed(objs):
+            if isinstance(obj, TextLayout):
+                elt = obj.node_at(x)
+            else:
+                elt = obj.node
+            if elt:
+                break
+        if not elt:
             return
-        elt = objs[-1].node
         if elt and self.js.dispatch_event("click", elt):
             return
         while elt:
@@ -1043,8 +2530,9 @@ class Tab:
                 url = resolve_url(elt.attributes["href"], self.url)
                 return self.load(url)
             elif elt.tag == "input":
-                elt.attributes["value"] = ""
+                self.index.set_attribute(elt, "value", "")
                 self.focus = elt
+                self.repaint_input(elt)
                 return
             elif elt.tag == "button":
                 while elt:
@@ -1056,10 +2544,8 @@ class Tab:
     def submit_form(self, elt):
         if self.js.dispatch_event("submit", elt):
             return
-        inputs = [node for node in tree_to_list(elt, [])
-                  if isinstance(node, Element)
-                  and node.tag == "input"
-                  and "name" in node.attributes]
+        inputs = [node for node in self.index.elements("input", "name")
+                  if is_inside(node, elt)]
 
         body = ""
         for input in inputs:
@@ -1077,8 +2563,27 @@ class Tab:
         if self.focus:
             if self.js.dispatch_event("keydown", self.focus):
                 return
-            self.focus.attributes["value"] += char
-            self.render()
+            value = self.focus.attributes["value"] + char
+            self.index.set_attribute(self.focus, "value", value)
+            self.repaint_input(self.focus)
+
+    def repaint_input(self, node):
+        # an input's value never changes layout, so only its own draw
+        # commands need replacing
+        objs = []
+        if self.document and not self.needs_render:
+            objs = [obj for obj in self.document.layout_objects(node)
+                    if isinstance(obj, InputLayout)]
+        if not objs:
+            return self.render()
+        start, end = objs[0].display_range
+        old = self.display_list[start:end]
+        new = objs[0].commands()
+        if [(type(c), c.top, c.left, c.bottom) for c in old] != \
+           [(type(c), c.top, c.left, c.bottom) for c in new]:
+            return self.render()
+        self.display_list[start:end] = new
+        self.canvas_stale.update(range(start, end))
 
     def go_back(self):
         if len(self.history) > 1:
@@ -1100,30 +2605,34 @@ class InputLayout:
         self.y = None
         self.width = None
         self.height = None
+        self.document = parent.document
+        self.document.inlines.setdefault(node, []).append(self)
 
     def layout(self):
-        weight = self.node.style["font-weight"]
-        style = self.node.style["font-style"]
-        if style == "normal":
-            style = "roman"
-        size = int(float(self.node.style["font-size"][:-2]) * .75)
-        self.font = get_font(size, weight, style)
+        self.font = style_font(self.node.style)
 
         self.width = INPUT_WIDTH_PX
 
         if self.previous:
-            space = self.previous.font.measure(" ")
+            space = self.previous.font.space_width
             self.x = self.previous.x + space + self.previous.width
         else:
             self.x = self.parent.x
 
-        self.height = self.font.metrics("linespace")
+        self.height = self.font.linespace
 
         if self.node.attributes.get("type", "") == "hidden":
             self.height = 0.0
             self.width = 0.0
 
     def paint(self, display_list):
+        start = len(display_list)
+        display_list.extend(self.commands())
+        # lets a value change patch these commands without a full paint
+        self.display_range = (start, len(display_list))
+
+    def commands(self):
+        display_list = []
         bgcolor = self.node.style.get("background-color",
                                       "transparent")
         if bgcolor != "transparent":
@@ -1148,6 +2657,7 @@ class InputLayout:
         else:
             display_list.append(
                 DrawText(self.x, self.y, text, self.font, color))
+        return display_list
 
     def __repr__(self):
         # if self.node.tag == "input":
@@ -1225,22 +2735,23 @@ class JSContext:
         handle = self.node_to_handle.get(elt, -1)
         do_default = self.interp.evaljs(
             EVENT_DISPATCH_CODE, type=type, handle=handle)
+        self.tab.render_if_needed()
         return not do_default
 
     def get_handle(self, elt):
-        if elt not in self.node_to_handle:
+        handle = self.node_to_handle.get(elt)
+        if handle is None:
             handle = len(self.node_to_handle)
             self.node_to_handle[elt] = handle
             self.handle_to_node[handle] = elt
-        else:
-            handle = self.node_to_handle[elt]
         return handle
 
     def querySelectorAll(self, selector_text):
         selector = CSSParser(selector_text).selector()
-        nodes = [node for node
-                 in tree_to_list(self.tab.nodes, [])
-                 if selector.matches(node)]
+        nodes = self.tab.index.elements(selector.rightmost_tag)
+        # the tag bucket already matches a plain tag selector
+        if not isinstance(selector, TagSelector):
+            nodes = [node for node in nodes if selector.matches(node)]
         return [self.get_handle(node) for node in nodes]
 
     def getAttribute(self, handle, attr):
@@ -1251,10 +2762,9 @@ class JSContext:
         doc = HTMLParser("<html><body>" + s + "</body></html>").parse()
         new_nodes = doc.children[0].children
         elt = self.handle_to_node[handle]
-        elt.children = new_nodes
-        for child in elt.children:
-            child.parent = elt
-        self.tab.render()
+        self.tab.index.replace_children(elt, new_nodes)
+        self.tab.invalidate(elt)
+        self.tab.set_needs_render()
 
     def XMLHttpRequest_send(self, method, url, body):
         full_url = resolve_url(url, self.tab.url)
@@ -1267,8 +2777,45 @@ class JSContext:
 
 
 if __name__ == "__main__":
-    if len(sys.argv) == 1:
-        Browser().load(DEFAULT_FILE_URL)
+    args = sys.argv[1:]
+    cache_dir = None
+    headless = False
+    glyphs = None
+    capture = None
+    while args and args[0].startswith("--"):
+        if args[0] == "--cache-dir" and len(args) >= 2:
+            cache_dir = args[1]
+            args = args[2:]
+        elif args[0] == "--headless":
+            headless = True
+            args = args[1:]
+        elif args[0] == "--glyphs" and len(args) >= 2:
+            glyphs = args[1]
+            args = args[2:]
+        elif args[0] == "--capture-glyphs" and len(args) >= 2:
+            capture = args[1]
+            args = args[2:]
+        else:
+            break
+    url = args[0] if args else DEFAULT_FILE_URL
+
+    if capture:
+        tkinter.Tk().withdraw()
+        table = capture_page_glyph_table(TkFontBackend(), url)
+        with open(capture, "w") as f:
+            json.dump(table, f)
+    elif headless:
+        if cache_dir:
+            CACHE.disk = DiskCache(cache_dir)
+        if glyphs:
+            set_font_backend(load_glyph_table(glyphs))
+        else:
+            set_font_backend(FixedFontBackend())
+        tab = Tab()
+        tab.load(url)
+        for cmd in tab.display_list:
+            print(cmd)
     else:
-        Browser().load(sys.argv[1])
-    tkinter.mainloop()
+        Browser(cache_dir).load(url)
+        tkinter.mainloop()
+    POOL.close_all()
@@ -0,0 +1,36 @@
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import baseline
+import browser
+
+
+def measure(parser_class, text, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        parser_class(text).parse()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    with open(os.path.join(ROOT, "browser.css")) as f:
+        default = f.read()
+    rule = "div p span { color: red; font-size: 12px; " \
+        "background-color: blue }\n"
+    text = (default + rule * 50) * 80
+    size = len(text) / 1e6
+    new = measure(browser.CSSParser, text)
+    old = measure(baseline.CSSParser, text)
+    print("{:.2f} MB stylesheet: {:.2f} MB/s vs {:.2f} MB/s baseline "
+          "({:.1f}x)".format(size, size / new, size / old, old / new))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import baseline
+import browser
+
+
+def measure(parser_class, body, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        parser_class(body).parse()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    para = "<p>" + "lorem ipsum dolor sit amet " * 40 + \
+        "<b>bold</b> <a href=x>link</a></p>\n"
+    page = "<!doctype html><html><body>" + para * 2000 + "</body></html>"
+    nested = "<div>x" * 5000 + "</div>" * 5000
+    for name, body in [("flat page", page), ("deep nesting", nested)]:
+        size = len(body) / 1e6
+        new = measure(browser.HTMLParser, body)
+        old = measure(baseline.HTMLParser, body)
+        print("{}: {:.2f} MB, {:.2f} MB/s vs {:.2f} MB/s baseline "
+              "({:.1f}x)".format(name, size, size / new, size / old,
+                                 old / new))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import browser
+
+
+def linear_visible(display_list, top, bottom):
+    return [i for i, cmd in enumerate(display_list)
+            if not cmd.top > bottom and not cmd.bottom < top]
+
+
+def main():
+    os.chdir(ROOT)
+    browser.set_font_backend(browser.FixedFontBackend())
+    section = "<div style=\"background-color:lightblue\"><p>" + \
+        "word " * 60 + "<b>bold</b> <i>it</i> " * 10 + "</p></div>"
+    tab = browser.Tab()
+    tab.nodes = browser.HTMLParser(
+        "<html><body>" + section * 2100 + "</body></html>").parse()
+    tab.rules = list(tab.default_style_sheet)
+    tab.render()
+    display_list = tab.display_list
+    view = browser.HEIGHT - browser.CHROME_PX
+    scrolls = range(0, int(tab.document.height) - view, browser.SCROLL_STEP)
+
+    start = time.perf_counter()
+    index = browser.DisplayListIndex(display_list)
+    build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for scroll in scrolls:
+        linear_visible(display_list, scroll, scroll + view)
+    old = time.perf_counter() - start
+    start = time.perf_counter()
+    for scroll in scrolls:
+        index.visible(scroll, scroll + view)
+    new = time.perf_counter() - start
+
+    for scroll in scrolls:
+        assert index.visible(scroll, scroll + view) == \
+            linear_visible(display_list, scroll, scroll + view)
+    steps = len(scrolls)
+    print("{} commands, {} scroll steps: {:.1f} us per step vs {:.1f} us "
+          "linear, index built in {:.1f} ms".format(
+              len(display_list), steps, new / steps * 1e6,
+              old / steps * 1e6, build * 1e3))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import baseline
+import browser
+
+
+TAGS = [
+    "div", "p", "span", "a", "b", "i", "li", "ul", "section", "article",
+    "em", "strong", "h1", "h2", "nav", "footer",
+]
+
+
+def stylesheet(count, seed=2):
+    rng = random.Random(seed)
+    text = ""
+    for i in range(count):
+        words = [rng.choice(TAGS + ["x{}".format(rng.randint(0, 200))])
+                 for _ in range(rng.randint(1, 4))]
+        text += "{} {{ color: c{}; font-size: {}% }}\n".format(
+            " ".join(words), i, rng.randint(80, 120))
+    return text
+
+
+def styles(node, out):
+    out.append(sorted(node.style.items()))
+    for child in node.children:
+        styles(child, out)
+    return out
+
+
+def run(module, css, html):
+    rules = sorted(module.CSSParser(css).parse(),
+                   key=module.cascade_priority)
+    tree = module.HTMLParser(html).parse()
+    start = time.perf_counter()
+    module.style(tree, rules)
+    return time.perf_counter() - start, len(rules), styles(tree, [])
+
+
+def main():
+    item = "<li><a href=x>a <b>b</b></a> <span>s <em>e</em></span></li>"
+    html = "<body>" + ("<section><ul>" + item * 20 + "</ul></section>") * 15 \
+        + "</body>"
+    for count in [300, 3000]:
+        css = stylesheet(count)
+        new, rules, new_styles = run(browser, css, html)
+        old, _, old_styles = run(baseline, css, html)
+        assert new_styles == old_styles
+        print("{} rules, {} nodes: {:.3f}s vs {:.3f}s baseline "
+              "({:.1f}x)".format(rules, len(new_styles), new, old,
+                                 old / new))
+
+
+if __name__ == "__main__":
+    main()
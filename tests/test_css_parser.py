@@ -0,0 +1,57 @@
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import baseline
+import browser
+
+
+PIECES = [
+    "p", "div", " ", "\n", "{", "}", ":", ";", "color", "red", "#fff",
+    "12px", "90%", ",", ".x", "/*", "*/", "a b", "\t", "_", "é", "!",
+    ">",
+]
+
+STYLESHEETS = [
+    "",
+    "   ",
+    "p{color:red}",
+    "p { color: red } x",
+    "div p { font-size: 90%; background-color: #fff }",
+]
+
+
+def outcome(module, text, method):
+    parser = module.CSSParser(text)
+    try:
+        return repr(getattr(parser, method)()), parser.i
+    except AssertionError:
+        # selector() raises part-way through a word, where the two
+        # parsers may have stopped at different offsets
+        return "AssertionError", parser.i if method != "selector" else None
+
+
+def random_stylesheets(count, seed=5):
+    rng = random.Random(seed)
+    for _ in range(count):
+        yield "".join(rng.choice(PIECES) for _ in range(rng.randint(0, 30)))
+
+
+def test_matches_baseline_parser(count=5000):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sheets = list(STYLESHEETS)
+    for name in ["browser.css", "comment.css"]:
+        with open(os.path.join(root, name)) as f:
+            sheets.append(f.read())
+    sheets.extend(random_stylesheets(count))
+    for text in sheets:
+        for method in ["parse", "body", "selector"]:
+            assert outcome(browser, text, method) \
+                == outcome(baseline, text, method), (text, method)
+
+
+if __name__ == "__main__":
+    test_matches_baseline_parser(30000)
+    print("ok")
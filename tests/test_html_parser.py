@@ -0,0 +1,72 @@
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import baseline
+import browser
+
+
+PIECES = [
+    "<p>", "</p>", "<b>", "</b>", "<div>", "</div>", "x", " ", "<i>", "</i>",
+    "<br>", "<head>", "<script>", "</script>", "<!-- c -->", "<a href=x>",
+    "</a>", "\n", "<", ">", "<input name=a value='b c'>", "<title>", "text",
+]
+
+DOCUMENTS = [
+    "<html><body><p>hi <b>there</b></p></body></html>",
+    "<p>a<b>b<i>c<p>d</i>e</b>f",
+    "<!doctype html><title>x</title><link rel=stylesheet href=a.css>"
+    "<p class='x y'>t",
+    "text only",
+    "",
+    "<div><p>one<p>two<div>three</div></div>",
+    "<br><hr><input name=a value=b>",
+]
+
+
+def dump(node, out):
+    if isinstance(node, (browser.Text, baseline.Text)):
+        out.append(("text", node.text))
+        return out
+    out.append((node.tag, sorted(node.attributes.items()),
+                len(node.children)))
+    for child in node.children:
+        dump(child, out)
+    return out
+
+
+def outcome(parse):
+    try:
+        return dump(parse(), [])
+    except Exception as e:
+        return type(e).__name__
+
+
+def parse_in_chunks(body, size):
+    parser = browser.HTMLParser()
+    for i in range(0, len(body), size):
+        parser.feed(body[i:i + size])
+    return parser.close()
+
+
+def random_documents(count, seed=1):
+    rng = random.Random(seed)
+    for _ in range(count):
+        yield "".join(rng.choice(PIECES) for _ in range(rng.randint(0, 40)))
+
+
+def test_matches_baseline_parser(count=3000):
+    for body in DOCUMENTS + list(random_documents(count)):
+        expected = outcome(lambda: baseline.HTMLParser(body).parse())
+        assert outcome(lambda: browser.HTMLParser(body).parse()) \
+            == expected, body
+        for size in [1, 3, 17]:
+            assert outcome(lambda: parse_in_chunks(body, size)) \
+                == expected, (body, size)
+
+
+if __name__ == "__main__":
+    test_matches_baseline_parser(20000)
+    print("ok")
@@ -0,0 +1,59 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import browser
+
+
+PAGE_URL = "http://example.test/page"
+PAGE = "<div>placeholder</div><script src=load.js></script>"
+
+
+def words(tab):
+    return [cmd.text for cmd in tab.display_list
+            if isinstance(cmd, browser.DrawText)]
+
+
+def load_page(run):
+    # serve the page from a fresh cache entry and stand in for the script
+    # engine, so the load is headless and offline
+    browser.CACHE.put(PAGE_URL, {"cache-control": "max-age=3600"}, PAGE)
+    browser.CACHE.put(browser.resolve_url("load.js", PAGE_URL),
+                      {"cache-control": "max-age=3600"}, "")
+    previous_run = browser.JSContext.run
+    previous_dir = os.getcwd()
+    browser.JSContext.run = run
+    os.chdir(ROOT)
+    try:
+        tab = browser.Tab()
+        tab.load(PAGE_URL)
+    finally:
+        browser.JSContext.run = previous_run
+        os.chdir(previous_dir)
+    return tab
+
+
+def test_mutation_after_load_time_inner_html():
+    def run(js, code):
+        div = js.querySelectorAll("div")[0]
+        js.innerHTML_set(div, "<span>old</span>")
+
+    previous_backend = browser.FONT_BACKEND
+    browser.set_font_backend(browser.FixedFontBackend())
+    try:
+        tab = load_page(run)
+        assert words(tab) == ["old"]
+
+        span = tab.js.querySelectorAll("span")[0]
+        tab.js.innerHTML_set(span, "new")
+        tab.render_if_needed()
+        assert words(tab) == ["new"]
+    finally:
+        browser.set_font_backend(previous_backend)
+
+
+if __name__ == "__main__":
+    test_mutation_after_load_time_inner_html()
+    print("ok")